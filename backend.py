@@ -1,85 +1,177 @@
 import cv2
 import mediapipe as mp
+import numpy as np
+from numba import njit
 import asyncio
 import websockets
-import json
 import time
-import math
+import queue
+import struct
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 # Initialize MediaPipe at module level (matches the working legacy API pattern)
 # model_complexity=0 is the lightest/fastest model — less latency, less jitter
+# Tracking mode (static_image_mode=False, the default): each frame's landmark ROI is derived from
+# the previous frame's landmarks, and the palm detector is skipped only while the previous frame
+# tracked max_num_hands hands. So a single hand runs detector-free only on a max_num_hands=1
+# graph; the max_num_hands=2 graph takes over while two hands are in view (see HandDetector).
 mp_hands = mp.solutions.hands
-hands = mp_hands.Hands(
-    max_num_hands=2,
+_HANDS_OPTIONS = dict(
     model_complexity=0,
     min_detection_confidence=0.7,
     min_tracking_confidence=0.8,
 )
+hands_one = mp_hands.Hands(max_num_hands=1, **_HANDS_OPTIONS)
+hands_two = mp_hands.Hands(max_num_hands=2, **_HANDS_OPTIONS)
+# hands.process isn't thread-safe: every call goes through this single worker, which
+# serializes access without locks while MediaPipe runs off the event loop
+_INFER_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mp-infer")
+
+# Connected websockets -> their 1-slot send queue, fed by the single shared producer
+_clients = {}
+# The running producer task (None while the camera is closed), and a lock it holds for its whole
+# lifetime so a new producer can't reopen the camera before the previous one has released it
+_producer_task = None
+_camera_lock = asyncio.Lock()
 
 SEND_INTERVAL = 1 / 60      # cap at 60fps to prevent WebSocket queue buildup
+WRITE_LIMIT = 1 << 20        # 1 MiB transport high-water mark — routine sends never wait on drain
 SMOOTH_ALPHA = 0.35          # EMA weight for new sample (lower = smoother, more lag)
+ONE_MINUS_ALPHA = 1.0 - SMOOTH_ALPHA  # EMA weight for history, precomputed once
 PALM_HOLD_SECONDS = 3.0      # hold open palm this long to enter grab mode
-
-
-def _dist2(a, b):
-    return (a.x - b.x) ** 2 + (a.y - b.y) ** 2 + (a.z - b.z) ** 2
-
-
-def is_open_palm(lm): # True when all 4 fingers (index, middle, ring, pinky) are extended.
-    wrist = lm[0]
-    for tip_idx, pip_idx in [(8, 6), (12, 10), (16, 14), (20, 18)]:
-        tip = lm[tip_idx]
-        pip = lm[pip_idx]
-        tip_dist2 = _dist2(tip, wrist)
-        pip_dist2 = _dist2(pip, wrist)
-        # Extended = tip farther from wrist than PIP (relaxed 1.08), or tip above PIP (y down in image)
-        extended_by_dist = tip_dist2 > pip_dist2 * 1.08
-        extended_by_y = tip.y < pip.y
-        if not (extended_by_dist or extended_by_y):
-            return False
-    return True
-
-
-def palm_center(lm): # Stable palm anchor: average of wrist (0) and the 4 finger MCP joints (5,9,13,17)
-    pts = [0, 5, 9, 13, 17]
-    x = sum(lm[i].x for i in pts) / len(pts)
-    y = sum(lm[i].y for i in pts) / len(pts)
-    z = sum(lm[i].z for i in pts) / len(pts)
-    return x, y, z
-
-
-class HandState: # Per-hand smoothing state + open-palm grab timer
+CAPTURE_WIDTH = 640          # palm detector downsamples to 192x192 anyway — HD frames are wasted bandwidth
+CAPTURE_HEIGHT = 480
+CAPTURE_FPS = 30
+TWO_HAND_PROBE_FRAMES = 15   # while on the 1-hand graph, check this often for a second hand
+
+# Binary wire format, one 34-byte record per hand (little-endian):
+#   u8 hand index, u8 flags (bit 0 is_open_palm, bit 1 is_grabbing, bit 2 handedness == "Right"),
+#   f32 x, y, z, pinch_sq, palm_x, palm_y, palm_z, palm_hold_duration
+# A frame is the concatenation of the detected hands' records; an empty frame means no hands.
+_HAND_STRUCT = struct.Struct("<BB8f")
+FLAG_OPEN_PALM = 1 << 0
+FLAG_GRABBING = 1 << 1
+FLAG_RIGHT_HAND = 1 << 2
+
+
+# Landmark index tables — module-level so numba bakes them into `step` as constants
+_TIPS = np.array([8, 12, 16, 20])        # index, middle, ring, pinky fingertips
+_PIPS = np.array([6, 10, 14, 18])        # matching PIP joints
+_PALM_PTS = np.array([0, 5, 9, 13, 17])  # wrist + 4 finger MCP joints
+
+
+def landmarks_to_array(lm): # Copy the 21 MediaPipe landmarks into one (21, 3) float32 array, once per frame
+    return np.fromiter(
+        (v for p in lm for v in (p.x, p.y, p.z)), dtype=np.float32, count=63
+    ).reshape(21, 3)
+
+
+class HandDetector: # Routes frames to the 1-hand or 2-hand tracking graph so the palm detector can stay idle
+
+    def __init__(self, one, two):
+        self.one = one                 # max_num_hands=1 — detector-free while one hand is tracked
+        self.two = two                 # max_num_hands=2 — detector-free while two hands are tracked
+        self.two_hand_mode = False
+        self.frames_since_probe = 0
+
+    def detect(self, rgb_frame): # Returns (landmark arrays, handedness labels)
+        # While on the 1-hand graph, periodically ask the 2-hand graph whether a second hand appeared
+        probe = not self.two_hand_mode and self.frames_since_probe >= TWO_HAND_PROBE_FRAMES
+        graph = self.two if self.two_hand_mode or probe else self.one
+        result = graph.process(rgb_frame)
+        found = result.multi_hand_landmarks or []
+
+        if graph is self.two:
+            self.frames_since_probe = 0
+            if len(found) == 2:
+                self.two_hand_mode = True
+            elif self.two_hand_mode:
+                # Back to one hand: restart the 1-hand graph so it doesn't track from the ROI it
+                # carried before two-hand mode, which may be long stale
+                self.one.reset()
+                self.two_hand_mode = False
+        else:
+            self.frames_since_probe += 1
+
+        if not found:
+            return [], []
+        lm_arrs = [landmarks_to_array(h.landmark) for h in found]
+        return lm_arrs, [h.classification[0].label for h in result.multi_handedness]
+
+
+detector = HandDetector(hands_one, hands_two)
+
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def step(lm, state, alpha, beta): # Whole per-hand landmark pipeline as one compiled kernel; smooths `state` in place, returns open-palm flag
+    wx, wy, wz = lm[0, 0], lm[0, 1], lm[0, 2]
+
+    # Open palm: all 4 fingers (index, middle, ring, pinky) must be extended.
+    # Extended = tip farther from wrist than PIP (relaxed 1.08), or tip above PIP (y down in image)
+    open_palm = True
+    for k in range(_TIPS.shape[0]):
+        tip_idx, pip_idx = _TIPS[k], _PIPS[k]
+        tx, ty, tz = lm[tip_idx, 0] - wx, lm[tip_idx, 1] - wy, lm[tip_idx, 2] - wz
+        qx, qy, qz = lm[pip_idx, 0] - wx, lm[pip_idx, 1] - wy, lm[pip_idx, 2] - wz
+        tip_dist2 = tx * tx + ty * ty + tz * tz
+        pip_dist2 = qx * qx + qy * qy + qz * qz
+        if not (tip_dist2 > pip_dist2 * 1.08 or lm[tip_idx, 1] < lm[pip_idx, 1]):
+            open_palm = False
+            break
+
+    # Stable palm anchor: average of wrist (0) and the 4 finger MCP joints (5,9,13,17)
+    px = py = pz = 0.0
+    for i in _PALM_PTS:
+        px += lm[i, 0]
+        py += lm[i, 1]
+        pz += lm[i, 2]
+    n = _PALM_PTS.shape[0]
+
+    # Squared index tip (8) to thumb tip (4) distance in the image plane — no sqrt;
+    # the frontend compares it against squared thresholds
+    ix, iy, iz = lm[8, 0], lm[8, 1], lm[8, 2]
+    dx = lm[4, 0] - ix
+    dy = lm[4, 1] - iy
+    pinch_sq = dx * dx + dy * dy
+
+    # EMA smoothing (beta = 1 - alpha): index-tip x/y/z + pinch_sq (pointer / zoom), then palm-center x/y/z (node drag)
+    state[0] = alpha * ix + beta * state[0]
+    state[1] = alpha * iy + beta * state[1]
+    state[2] = alpha * iz + beta * state[2]
+    # Smoothed in the squared domain: mean of squares >= square of mean, so jitter biases it
+    # upward compared to squaring the old smoothed distance
+    state[3] = alpha * pinch_sq + beta * state[3]
+    state[4] = alpha * (px / n) + beta * state[4]
+    state[5] = alpha * (py / n) + beta * state[5]
+    state[6] = alpha * (pz / n) + beta * state[6]
+    return open_palm
+
+
+# Compile at import so the first tracked frame doesn't pay the JIT cost
+step(np.zeros((21, 3), dtype=np.float32), np.zeros(7, dtype=np.float32), 1.0, 0.0)
+
+
+class HandState: # Per-hand smoothing state + open-palm grab timer; the math lives in `step`
 
     def __init__(self):
+        self.ema = np.zeros(7, dtype=np.float32)
         self.reset()
 
     def reset(self):
-        # Cursor smoothing (index fingertip — used for normal pointer / pinch)
-        self.sx = self.sy = self.sz = self.spinch = None
-        # Palm-center smoothing (used when grabbing a node)
-        self.spx = self.spy = self.spz = None
+        self.tracking = False
         # Palm hold timer
         self.palm_start_time = None
         self.is_grabbing = False
 
-    def update(self, lm, open_palm, now):
-        tip = lm[8]     # index finger tip
-        thumb = lm[4]   # thumb tip
-        px, py, pz = palm_center(lm)
-        pinch = math.hypot(thumb.x - tip.x, thumb.y - tip.y)
-
-        # EMA smoothing
-        if self.sx is None:
-            self.sx, self.sy, self.sz, self.spinch = tip.x, tip.y, tip.z, pinch
-            self.spx, self.spy, self.spz = px, py, pz
+    def update(self, lm_arr, now, hand, handedness): # Returns this hand's packed _HAND_STRUCT record
+        # First sample after a reset seeds the EMA directly (alpha = 1, beta = 0)
+        if self.tracking:
+            open_palm = step(lm_arr, self.ema, SMOOTH_ALPHA, ONE_MINUS_ALPHA)
         else:
-            self.sx = SMOOTH_ALPHA * tip.x + (1 - SMOOTH_ALPHA) * self.sx
-            self.sy = SMOOTH_ALPHA * tip.y + (1 - SMOOTH_ALPHA) * self.sy
-            self.sz = SMOOTH_ALPHA * tip.z + (1 - SMOOTH_ALPHA) * self.sz
-            self.spinch = SMOOTH_ALPHA * pinch + (1 - SMOOTH_ALPHA) * self.spinch
-            self.spx = SMOOTH_ALPHA * px + (1 - SMOOTH_ALPHA) * self.spx
-            self.spy = SMOOTH_ALPHA * py + (1 - SMOOTH_ALPHA) * self.spy
-            self.spz = SMOOTH_ALPHA * pz + (1 - SMOOTH_ALPHA) * self.spz
+            open_palm = step(lm_arr, self.ema, 1.0, 0.0)
+        self.tracking = True
 
         # Palm hold timer 3ss
         if open_palm:
@@ -94,83 +186,202 @@ class HandState: # Per-hand smoothing state + open-palm grab timer
 
         hold_duration = (now - self.palm_start_time) if self.palm_start_time else 0.0
 
-        return {
-            # Index-tip cursor position + pinch (for normal pointer/zoom)
-            "x": self.sx,
-            "y": self.sy,
-            "z": self.sz,
-            "pinch": self.spinch,
-            # Palm-center position (front-end uses this to drag the grabbed node)
-            "palm_x": self.spx,
-            "palm_y": self.spy,
-            "palm_z": self.spz,
-            # Grab state — front-end reads these to enter/exit node-drag mode
-            "is_open_palm": open_palm,
-            "palm_hold_duration": min(hold_duration, PALM_HOLD_SECONDS),
-            "is_grabbing": self.is_grabbing,
-        }
-
-
-async def track_hands(websocket):
-    print("Streaming hand data")
-    last_send = 0.0
-    cap = cv2.VideoCapture(0)
+        flags = (
+            (FLAG_OPEN_PALM if open_palm else 0)
+            | (FLAG_GRABBING if self.is_grabbing else 0)
+            | (FLAG_RIGHT_HAND if handedness == "Right" else 0)
+        )
+        # EMA channels: index-tip cursor position + squared pinch distance (for normal pointer/zoom),
+        # then palm-center position (front-end uses this to drag the grabbed node)
+        return _HAND_STRUCT.pack(
+            hand, flags, *self.ema.tolist(), min(hold_duration, PALM_HOLD_SECONDS)
+        )
 
-    # Per-connection state so multiple clients never share smoothing buffers
-    hand_states = [HandState(), HandState()]
 
+def _capture_loop(frame_queue, stop_event): # Owns the camera; keeps only the freshest frame in the 1-slot queue
+    cap = cv2.VideoCapture(0)
+    # MJPG lets the driver deliver 640x480@30 over USB without dropping to a lower rate
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_HEIGHT)
+    cap.set(cv2.CAP_PROP_FPS, CAPTURE_FPS)
+    # Ask for a 1-frame driver buffer so read() returns the freshest frame (ignored by some backends)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
     try:
-        while cap.isOpened():
+        while not stop_event.is_set() and cap.isOpened():
             ret, frame = cap.read()
             if not ret:
                 break
+            try:
+                frame_queue.put_nowait(frame)
+            except queue.Full:
+                # Drop the stale frame the consumer hasn't picked up yet
+                try:
+                    frame_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                frame_queue.put_nowait(frame)
+    finally:
+        cap.release()
+        # Sentinel so the consumer stops instead of waiting on a dead camera
+        try:
+            frame_queue.get_nowait()
+        except queue.Empty:
+            pass
+        frame_queue.put_nowait(None)
+
+
+def _grab_latest(frame_queue): # Blocks a worker thread (not the event loop) until a frame is ready
+    # No timeout: opening and configuring a webcam can take seconds, and a dead camera
+    # is reported by the capture thread's None sentinel
+    return frame_queue.get()
+
+
+def _step_one(hand_states, lm_arr, label, now): # Common case — one hand in frame, no iteration
+    hand_states[1].reset()
+    return hand_states[0].update(lm_arr, now, 0, label)
+
+
+def _step_two(hand_states, lm_arrs, labels, now):
+    return (
+        hand_states[0].update(lm_arrs[0], now, 0, labels[0])
+        + hand_states[1].update(lm_arrs[1], now, 1, labels[1])
+    )
+
 
-            frame = cv2.flip(frame, 1)
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            result = hands.process(rgb_frame)
+def hands_payload(hand_states, lm_arrs, labels, now): # The tick's single frame: all hands' records, empty = heartbeat
+    # Fixed-arity paths (max_num_hands=2); labels are "Left" or "Right"
+    n = len(lm_arrs)
+    if n == 1:
+        return _step_one(hand_states, lm_arrs[0], labels[0], now)
+    if n == 2:
+        return _step_two(hand_states, lm_arrs, labels, now)
+    # No hands in frame — reset all state
+    for hs in hand_states:
+        hs.reset()
+    return b""
+
+
+def _publish(send_queue, payload): # Keep only the newest payload — gesture data is lossy, a stale frame is worthless
+    try:
+        send_queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        send_queue.get_nowait()
+        send_queue.put_nowait(payload)
+
+
+async def _sender(websocket, send_queue): # Drains the 1-slot queue to the socket; a slow client just sees fewer frames
+    while True:
+        payload = await send_queue.get()
+        await websocket.send(payload)
+
+
+def _ensure_producer(): # Start the shared producer unless one is already running
+    global _producer_task
+    if _producer_task is None:
+        _producer_task = asyncio.create_task(_producer())
+
+
+async def _producer(): # Owns the one camera + inference stream while clients are connected
+    async with _camera_lock:
+        await _run_camera()
+
+
+async def _run_camera(): # Capture + inference loop; fans each tick out to every client
+    global _producer_task
+    last_send = 0.0
+    loop = asyncio.get_running_loop()
+    orphaned = []  # clients to close if the camera dies or the producer crashes under them
+    close_reason = "camera unavailable"
+
+    frame_queue = queue.Queue(maxsize=1)
+    stop_event = threading.Event()
+    capture_thread = threading.Thread(
+        target=_capture_loop, args=(frame_queue, stop_event), daemon=True
+    )
+    capture_thread.start()
+
+    # One smoothing state per hand slot, shared by all clients since they all see the same stream
+    hand_states = [HandState(), HandState()]
+    rgb_frame = None
+
+    try:
+        while True:
+            # Paced by the camera: waiting for the next frame yields to the event loop,
+            # so no fixed sleep is needed
+            frame = await loop.run_in_executor(None, _grab_latest, frame_queue)
+            if frame is None or not _clients:
+                # Camera died, or the last client left — release the camera. Decided without an
+                # await in between, so any client connecting from here on starts a fresh producer.
+                _producer_task = None
+                if frame is None:
+                    orphaned = list(_clients)
+                break
+
+            # Mirror + BGR->RGB in one pass: reverse the column and channel axes, copied into a
+            # buffer reused across frames (inference on the previous frame has finished by now)
+            if rgb_frame is None or rgb_frame.shape != frame.shape:
+                rgb_frame = np.empty_like(frame)
+            np.copyto(rgb_frame, frame[:, ::-1, ::-1])
+            lm_arrs, labels = await loop.run_in_executor(_INFER_POOL, detector.detect, rgb_frame)
 
             now = time.monotonic()
-            hands_data = []
-
-            if result.multi_hand_landmarks:
-                for idx, (hand_lm, handedness) in enumerate(
-                    zip(result.multi_hand_landmarks, result.multi_handedness)
-                ):
-                    lm = hand_lm.landmark
-                    open_palm = is_open_palm(lm)
-                    label = handedness.classification[0].label  # "Left" or "Right"
-
-                    state = hand_states[min(idx, 1)]
-                    data = state.update(lm, open_palm, now)
-                    data["hand"] = idx
-                    data["handedness"] = label
-                    hands_data.append(data)
-
-                # Reset state for any hand slot that lost tracking this frame
-                detected = len(result.multi_hand_landmarks)
-                for i in range(detected, 2):
-                    hand_states[i].reset()
-            else:
-                # No hands in frame — reset all state
-                for hs in hand_states:
-                    hs.reset()
+            payload = hands_payload(hand_states, lm_arrs, labels, now)
 
             # Rate-limit sends to 60 fps
             if now - last_send >= SEND_INTERVAL:
-                await websocket.send(json.dumps({"hands": hands_data}))
+                # Exactly one binary frame per tick, carrying every hand, computed once for all clients
+                for send_queue in _clients.values():
+                    _publish(send_queue, payload)
                 last_send = now
-
-            await asyncio.sleep(0.005)
+    except Exception:
+        # Logged here rather than re-raised: nothing awaits the producer task to retrieve it
+        print("Hand tracking producer crashed:")
+        traceback.print_exc()
+        orphaned = list(_clients)
+        close_reason = "hand tracking failed"
     finally:
-        cap.release()
+        if _producer_task is asyncio.current_task():
+            _producer_task = None  # crashed — let the next client start over
+        stop_event.set()
+        await loop.run_in_executor(None, capture_thread.join)
+        print("Camera released")
+        if orphaned:
+            # Server keeps running; clients can reconnect to retry the camera
+            await asyncio.gather(
+                *(ws.close(1011, close_reason) for ws in orphaned),
+                return_exceptions=True,
+            )
+
+
+async def track_hands(websocket): # Per-client handler: receive the shared stream until the client leaves
+    print("Streaming hand data")
+    # Sends run in their own task so a slow client never stalls the producer or other clients
+    send_queue = asyncio.Queue(maxsize=1)
+    send_task = asyncio.create_task(_sender(websocket, send_queue))
+    _clients[websocket] = send_queue
+    _ensure_producer()
+    try:
+        await websocket.wait_closed()
+    finally:
+        del _clients[websocket]
+        send_task.cancel()
+        await asyncio.gather(send_task, return_exceptions=True)
         print("Client disconnected")
 
 
 async def main():
-    async with websockets.serve(track_hands, "localhost", 8765):
+    # write_limit is applied to each connection's transport via set_write_buffer_limits
+    async with websockets.serve(track_hands, "localhost", 8765, write_limit=WRITE_LIMIT):
         print("WebSocket Server started on ws://localhost:8765")
-        await asyncio.Future()  # Run forever
+        await asyncio.Future()  # Run forever; the camera opens with the first client
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop (libuv) speeds up socket I/O and task scheduling; it has no Windows build
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())